@@ -12,9 +12,11 @@ import plotly.express as px
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output
-import re
 import os
 from flask_caching import Cache
+from numba import njit
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 def boot():
 
@@ -53,32 +55,33 @@ def open_data(anno_file) :
     input: AADR dataset
     output: dataframes for Y-chromosome and mitochondrial DNA.
     '''
-    # Load the data
-    df = pd.read_csv(anno_file, sep="\t", low_memory=False)
+    date_col = 'Date mean in BP in years before 1950 CE [OxCal mu for a direct radiocarbon date, and average of range for a contextual date]'
 
-    # Replace commas with dots for the entire Dataframe
-    df = df.replace(',', '.', regex=True)
+    # Columns needed downstream for each genetic carrier
+    y_cols = ['Master ID', 'Lat.', 'Long.', 'Political Entity', date_col, 'Y haplogroup (manual curation in ISOGG format)']
+    mt_cols = ['Master ID', 'Lat.', 'Long.', 'Political Entity', date_col, 'mtDNA haplogroup if >2x or published']
 
-    # Replace ".." with NaN 
-    df = df.replace('..', pd.NA, regex=False)
+    # Load the data in chunks, only reading the columns needed. ".." is read as NaN
+    chunks = []
+    for chunk in pd.read_csv(anno_file, sep="\t", usecols=list(dict.fromkeys(y_cols + mt_cols)), dtype=str, na_values=['..'], chunksize=200_000):
+        # Replace decimal commas with dots in the coordinate and sample age columns and convert them to numeric, non-numeric entries are coerced to NaN
+        for col in ['Lat.', 'Long.', date_col]:
+            chunk[col] = pd.to_numeric(chunk[col].str.replace(',', '.', regex=False), errors='coerce')
 
-    df.dropna(subset=['Lat.'], inplace=True)
-    df.dropna(subset=['Long.'], inplace=True)
+        # Drop rows without coordinates or without any haplogroup
+        chunk = chunk.dropna(subset=['Lat.', 'Long.'])
+        chunk = chunk.dropna(subset=['Y haplogroup (manual curation in ISOGG format)', 'mtDNA haplogroup if >2x or published'], how='all')
+        chunks.append(chunk)
+    df = pd.concat(chunks, ignore_index=True)
 
-    # Remove non-numeric sample ages
-    sample_ages = [str(age) if str(age).isnumeric() else 'n/a' for age in df['Date mean in BP in years before 1950 CE [OxCal mu for a direct radiocarbon date, and average of range for a contextual date]']]
-    df['Date mean in BP in years before 1950 CE [OxCal mu for a direct radiocarbon date, and average of range for a contextual date]'] = pd.to_numeric(sample_ages, errors='coerce')
-    
-    # Convert 'Lat.' to numeric, coercing errors to NaN
-    df['Lat.'] = pd.to_numeric(df['Lat.'], errors='coerce')
-    df['Long.'] = pd.to_numeric(df['Long.'], errors='coerce')
+    # Political entities repeat across many samples, store them as categories
+    df['Political Entity'] = df['Political Entity'].astype('category')
 
-    y_df = df
-    mt_df = df
+    # Keep the rows where the haplogroup is present, as separate dataframes
+    y_df = df.loc[df['Y haplogroup (manual curation in ISOGG format)'].notna(), y_cols].copy()
+    mt_df = df.loc[df['mtDNA haplogroup if >2x or published'].notna(), mt_cols].copy()
+    del df
 
-    # Drop rows where haplogroups are NaN for both dataframes
-    y_df.dropna(subset=['Y haplogroup (manual curation in ISOGG format)'], inplace=True)
-    mt_df.dropna(subset=['mtDNA haplogroup if >2x or published'], inplace=True)
     # Return dataframes
     return y_df, mt_df
 
@@ -102,12 +105,84 @@ def create_bins(y_df, mt_df, bin_choice) :
     mt_df['DateBins'] = pd.cut(mt_df['Date mean in BP in years before 1950 CE [OxCal mu for a direct radiocarbon date, and average of range for a contextual date]'], bins=bins, labels=labels, right=False)
     y_df['DateBins'] = pd.cut(y_df['Date mean in BP in years before 1950 CE [OxCal mu for a direct radiocarbon date, and average of range for a contextual date]'], bins=bins, labels=labels, right=False)
 
-    y_df['CombinedBins'] = y_df['Political Entity'] + " (" + y_df['DateBins'].astype('str') + "BP)"
-    mt_df['CombinedBins'] = mt_df['Political Entity'] + " (" + mt_df['DateBins'].astype('str') + "BP)"
+    # Encode every (political entity, date bin) pair as one integer, shared by both dataframes. Pairs with a missing entity or bin get -1
+    entities = pd.concat([y_df['Political Entity'], mt_df['Political Entity']]).astype('category').cat.categories
+    def pair_codes(df):
+        entity_codes = pd.Categorical(df['Political Entity'], categories=entities).codes.astype(np.int64)
+        bin_codes = df['DateBins'].cat.codes.to_numpy().astype(np.int64)
+        return np.where((entity_codes >= 0) & (bin_codes >= 0), entity_codes * len(labels) + bin_codes, -1)
+
+    y_pair_codes = pair_codes(y_df)
+    mt_pair_codes = pair_codes(mt_df)
+
+    # Build the "Country (start-endBP)" label once per observed pair instead of once per sample
+    observed_pairs = np.unique(np.concatenate([y_pair_codes, mt_pair_codes]))
+    observed_pairs = observed_pairs[observed_pairs >= 0]
+    combined_labels = [f"{entities[pair // len(labels)]} ({labels[pair % len(labels)]}BP)" for pair in observed_pairs]
+
+    # Map the pair codes to positions in the label list, keeping -1 for missing pairs
+    y_df['CombinedBins'] = pd.Categorical.from_codes(np.where(y_pair_codes >= 0, np.searchsorted(observed_pairs, y_pair_codes), -1), categories=combined_labels)
+    mt_df['CombinedBins'] = pd.Categorical.from_codes(np.where(mt_pair_codes >= 0, np.searchsorted(observed_pairs, mt_pair_codes), -1), categories=combined_labels)
 
     # Return dataframes
     return y_df, mt_df
 
+def read_dict_from_file(file_path, key_index, value_index):
+    '''
+    Loads a dictionary from a whitespace-separated file. Lines lacking the key or value field are skipped.
+
+    input: file path, key_index and value_index correspond to the fields where they are found, respectively.
+    output: dictionary mapping the key field to the value field.
+    '''
+    # Parse the file with the C tokenizer, only keeping the key and value fields
+    fields = pd.read_csv(file_path, sep=r'\s+', engine='c', header=None, names=range(max(key_index, value_index) + 1), index_col=False, usecols=[key_index, value_index], dtype=str, na_filter=False)
+
+    # Skip lines that are too short to carry a value
+    fields = fields[fields[value_index] != '']
+    return dict(zip(fields[key_index], fields[value_index]))
+
+@njit(cache=True)
+def walk_haplogroup_codes(haplo_codes, lookup, single_char):
+    '''
+    Walks the integer-coded haplogroup dictionary until each haplogroup is refered to by one character, Max 50 loops.
+
+    input: haplogroup codes, the code each haplogroup maps to and whether each haplogroup is a single character.
+    output: codes of the basal haplogroups.
+    '''
+    resolved = np.empty_like(haplo_codes)
+    for index in range(len(haplo_codes)):
+        code = haplo_codes[index]
+        for loop in range(50):
+            if single_char[code]:
+                break
+            updated_code = lookup[code]
+            # Stop once the haplogroup no longer changes, e.g. n/a
+            if updated_code == code:
+                break
+            code = updated_code
+        resolved[index] = code
+    return resolved
+
+def resolveBasalHaplogroups(haplo_data, combined_dict):
+    '''
+    Resolves haplogroups to their basal haplogroups by repeatedly looking them up in the merged dictionary. Haplogroups that are not found are replaced with n/a.
+
+    input: cleaned haplogroups and the merged dictionary.
+    output: basal haplogroups.
+    '''
+    # Encode every haplogroup name as an integer, so that the dictionary can be walked as an array
+    dict_keys = np.array(list(combined_dict.keys()), dtype=object)
+    dict_values = np.array(list(combined_dict.values()), dtype=object)
+    haplo_names = pd.Index(pd.unique(np.concatenate([dict_keys, dict_values, haplo_data.to_numpy(dtype=object), np.array(["n/a"], dtype=object)])))
+    lookup = np.full(len(haplo_names), haplo_names.get_loc("n/a"), dtype=np.int64)
+    lookup[haplo_names.get_indexer(dict_keys)] = haplo_names.get_indexer(dict_values)
+    single_char = np.asarray(haplo_names.str.len() <= 1, dtype=bool)
+
+    # Resolve every distinct haplogroup once, then map the results back onto all samples
+    sample_codes, unique_haplos = pd.factorize(haplo_data)
+    resolved_codes = walk_haplogroup_codes(haplo_names.get_indexer(unique_haplos).astype(np.int64), lookup, single_char)
+    return pd.Series(haplo_names[resolved_codes].to_numpy()[sample_codes], index=haplo_data.index, dtype='category')
+
 def findYBasalHaplogroups(y_df, y_snp_file, y_basal_file, y_locus_file):
 
     '''
@@ -116,55 +191,25 @@ def findYBasalHaplogroups(y_df, y_snp_file, y_basal_file, y_locus_file):
     input: binned dataframes for Y-chromosome and mitochondrial DNA as well as Y_SNP_FILE, Y_LOCUS_FILE and Y_PHYLO_FILE
     output: Y-chromosome dataframe, now containing the basal haplogroups.
     '''
-    # regular expression for replacing spaces with tabs
-    space_to_tab = re.compile(r'\s+')
-
-    # Function that loads a dictionary from a file
-    # key_index and value_index correspond to the fields where they are found, respectively.
-    def read_dict_from_file(file_path, key_index, value_index, split_char='\t'):
-        result_dict = {}
-        with open(file_path, 'r') as file:
-            for line in file:
-                parts = space_to_tab.sub(split_char, line.strip()).split(split_char)
-                if len(parts) >= max(key_index, value_index) + 1:
-                    result_dict[parts[key_index].strip()] = parts[value_index].strip()
-        return result_dict
-
     # Call the read_dict_from_file function.
     y_basal_dict = read_dict_from_file(y_basal_file, 0, 1)
     y_snp_dict = read_dict_from_file(y_snp_file, 1, 3)
     y_locus_dict = read_dict_from_file(y_locus_file, 1, 3)
 
-    # Clean the data using list comprehension
-    y_haplo_data = [haplo.split(";")[0].split("-")[0].split("(")[0].replace('~', "").replace('*', "") for haplo in y_df["Y haplogroup (manual curation in ISOGG format)"].tolist()]
+    # Clean the data using vectorised string operations
+    y_haplo_data = y_df["Y haplogroup (manual curation in ISOGG format)"].astype(str).str.split(";").str[0].str.split("-").str[0].str.split("(").str[0].str.replace('~', "", regex=False).str.replace('*', "", regex=False)
 
     # Reverse the dictionary for easier use in the loop below
     y_snp_dict_inv = {v: k for k, v in y_snp_dict.items()}
 
-    # Update haplogroup data based on dictionaries
-    loop = 0
-
-    # Loop as long as there are haplogroups that aren't references by one letter (that isnt n/a(Female)), Max 30 loops
-    while any(len(item) > 1 and item != 'n/a(Female)' for item in y_haplo_data) and loop < 50:
-        loop += 1
-        # Loop through every haplogroup
-        for index, haplo in enumerate(y_haplo_data):
-            # If the haplogroup is refered to as with more than a character 
-            if len(haplo) > 1:
-                # Check phylo file
-                if haplo in y_basal_dict and y_basal_dict[haplo] not in ['#', "Root"]:
-                    y_haplo_data[index] = y_basal_dict[haplo]
-                # Check SNP file
-                elif haplo in y_snp_dict_inv:
-                    y_haplo_data[index] = y_snp_dict_inv[haplo]
-                # Check locus file
-                elif haplo in y_locus_dict:
-                    y_haplo_data[index] = y_locus_dict[haplo]
-                # Replace haplogroup with n/a if its not found
-                else:
-                    y_haplo_data[index] = "n/a"
-        # Replace the column in the y-chromosome dataframe w/ y_haplo_data
-        y_df["Y haplogroup (manual curation in ISOGG format)"] = y_haplo_data
+    # Merge the dictionaries into a single lookup. Later entries take precedence: phylo file > SNP file > locus file
+    y_combined_dict = {**y_locus_dict, **y_snp_dict_inv, **{k: v for k, v in y_basal_dict.items() if v not in ['#', "Root"]}}
+
+    # Update haplogroup data based on the merged dictionary
+    y_haplo_data = resolveBasalHaplogroups(y_haplo_data, y_combined_dict)
+
+    # Replace the column in the y-chromosome dataframe w/ y_haplo_data
+    y_df["Y haplogroup (manual curation in ISOGG format)"] = y_haplo_data
     
     # Return dataframe, now containing the basal haplogroups
     return y_df
@@ -176,52 +221,23 @@ def findMTBasalHaplogroups(mt_df, mt_snp_file, mt_basal_file):
     input: binned dataframes for Y-chromosome and mitochondrial DNA as well as Y_SNP_FILE, Y_LOCUS_FILE and Y_PHYLO_FILE
     output: mitochondrial DNA dataframe, now containing the basal haplogroups.
     '''
-    # Function that loads a dictionary from a file
-    # key_index and value_index correspond to the fields where they are found, respectively.
-    def read_dict_from_file(file_path, key_index, value_index, split_char='\t'):
-        result_dict = {}
-        with open(file_path, 'r') as file:
-            for line in file:
-                parts = space_to_tab.sub(split_char, line.strip()).split(split_char)
-                if len(parts) >= max(key_index, value_index) + 1:
-                    result_dict[parts[key_index].strip()] = parts[value_index].strip()
-        return result_dict
-    
-    # regular expression for replacing spaces with tabs
-    space_to_tab = re.compile(r'\s+')
-
     # Create mtDNA haplogroup dictionary from a phylogenetic tree file
     mt_basal_dict = read_dict_from_file(mt_basal_file, 0, 1)
 
     # Create mutant dictionary from SNP file (keeping the provided file path even though it's labeled "y")
     mutant_dict = read_dict_from_file(mt_snp_file, 1, 3)
 
-    # Clean the data using list comprehension
-    mt_haplo_data = mt_df['mtDNA haplogroup if >2x or published'].tolist()
-    mt_haplo_data = [haplo.split(";")[0].split("-")[0].split("(")[0].replace('~', "").replace('*', "") for haplo in mt_haplo_data]
+    # Clean the data using vectorised string operations
+    mt_haplo_data = mt_df['mtDNA haplogroup if >2x or published'].astype(str).str.split(";").str[0].str.split("-").str[0].str.split("(").str[0].str.replace('~', "", regex=False).str.replace('*', "", regex=False)
 
     # Reverse the dictionary for easier use in the loop below
     mutant_dict_inv = {v: k for k, v in mutant_dict.items()}
 
-    # Update haplogroup data based on dictionaries
-    loop = 0
-    # Loop as long as there are haplogroups that aren't references by one letter (that isnt n/a(Female)), Max 30 loops
-    while any(len(item) > 1 and item != 'n/a(Female)' for item in mt_haplo_data) and loop < 50:
-        loop += 1
-
-        # Loop through every haplogroup
-        for index, haplo in enumerate(mt_haplo_data):
-            # If the haplogroup is refered to as with more than a character 
-            if len(haplo) > 1:  
-                # check phylo file
-                if haplo in mt_basal_dict and mt_basal_dict[haplo] not in ['#', "Root"]:
-                    mt_haplo_data[index] = mt_basal_dict[haplo]
-                # check mutant file
-                elif haplo in mutant_dict_inv:
-                    mt_haplo_data[index] = mutant_dict_inv[haplo]
-                # replace with n/a if not present
-                else:
-                    mt_haplo_data[index] = "n/a"
+    # Merge the dictionaries into a single lookup. Later entries take precedence: phylo file > mutant file
+    mt_combined_dict = {**mutant_dict_inv, **{k: v for k, v in mt_basal_dict.items() if v not in ['#', "Root"]}}
+
+    # Update haplogroup data based on the merged dictionary
+    mt_haplo_data = resolveBasalHaplogroups(mt_haplo_data, mt_combined_dict)
     
     # Update data frame with basal haplogroups
     mt_df['Updated mtDNA haplogroup'] = mt_haplo_data  
@@ -236,43 +252,31 @@ def createDummyVariables (y_df, mt_df) :
     input: mitochondrial DNA dataframe and Y-chromosome dataframe containing basal haplogroups.
     output: mitochondrial DNA dataframe and Y-chromosome dataframe containing basal haplogroups and dummy-variable dataframe for each.
     '''
-    # Y HAPLOTYPE DUMMY VARIABLES
-    y_dummies = pd.get_dummies(y_df['Y haplogroup (manual curation in ISOGG format)']) # The y haplogroups
-    mt_dummies = pd.get_dummies(mt_df['mtDNA haplogroup if >2x or published']) # The mt haplogroups
+    # Some haplogroups cannot be further tracked than 'I2', to which the basal haplogroup is I. Since HaploMapper visualises the basal haplogroups, the first letter is retrieved
+    y_letters = y_df['Y haplogroup (manual curation in ISOGG format)'].astype(str).str[0] # The y haplogroups
+    mt_letters = mt_df['mtDNA haplogroup if >2x or published'].astype(str).str[0] # The mt haplogroups
 
-    # Keep columns that dont start with 'n', as they are n/a or nan
-    y_cols_to_keep = [col for col in y_dummies.columns if not col.startswith('n') and col[0].isalpha()]
-    mt_cols_to_keep = [col for col in mt_dummies.columns if not col.startswith('n') and col[0].isalpha()]
+    # Keep haplogroups that start with an upper-case letter. This drops n/a and nan, as well as entries without a colour on the map (e.g. rCRS)
+    y_valid = y_letters.str.match(r'[A-Z]').fillna(False).astype(bool)
+    mt_valid = mt_letters.str.match(r'[A-Z]').fillna(False).astype(bool)
 
-    # Subset the dummy variables dataframes
-    y_dummies = y_dummies[y_cols_to_keep].copy()
-    mt_dummies = mt_dummies[mt_cols_to_keep].copy()
+    # Encode the starting letters as categories, excluded haplogroups get the code -1
+    y_categories = pd.Categorical(y_letters.where(y_valid))
+    mt_categories = pd.Categorical(mt_letters.where(mt_valid))
 
-    # Some haplogroups cannot be further tracked than 'I2', to which the basal haplogroup is I. Since HaploMapper visualises the basal haplogroups, the first letter is retrieved
-    y_unique_starting_letters = set(col[0] for col in y_dummies.columns)
-    mt_unique_starting_letters = set(col[0] for col in mt_dummies.columns)
-
-    # Identify the haplogroup-carrying columns
-    for letter in y_unique_starting_letters:
-        cols_to_sum = [col for col in y_dummies.columns if col.startswith(letter)]
-        y_dummies[f'{letter}_y_sum'] = y_dummies[cols_to_sum].sum(axis=1)
-   
-    # Identify the haplogroup-carrying columns
-    for letter in mt_unique_starting_letters:
-        cols_to_sum = [col for col in mt_dummies.columns if col.startswith(letter)]
-        mt_dummies[f'{letter}_mt_sum'] = mt_dummies[cols_to_sum].sum(axis=1)
-
-    # Copy the haplogroup sum. This corresponds to the number of individuals found at any given sampling site 
-    y_dummies_summed = y_dummies.filter(like='_sum').copy()
-    y_dummies_summed["y_haplos_sum"] = y_dummies_summed.sum(axis=1)
-
-    # Copy the haplogroup sum. This corresponds to the number of individuals found at any given sampling site 
-    mt_dummies_summed = mt_dummies.filter(like='_sum').copy()
-    mt_dummies_summed["mt_haplos_sum"] = mt_dummies_summed.sum(axis=1)
-
-    # Convert all columns to float for division
-    y_dummies_summed = y_dummies_summed.astype(float)
-    mt_dummies_summed = mt_dummies_summed.astype(float)
+    # Y HAPLOTYPE DUMMY VARIABLES, one column per starting letter. Each valid sample sets a single cell
+    y_dummies = np.zeros((len(y_categories), len(y_categories.categories)), dtype=np.float32)
+    y_dummies[np.flatnonzero(y_valid), y_categories.codes[y_valid.to_numpy()]] = 1.0
+    y_dummies_summed = pd.DataFrame(y_dummies, columns=[f'{letter}_y_sum' for letter in y_categories.categories], index=y_df.index)
+
+    # MT HAPLOTYPE DUMMY VARIABLES, one column per starting letter. Each valid sample sets a single cell
+    mt_dummies = np.zeros((len(mt_categories), len(mt_categories.categories)), dtype=np.float32)
+    mt_dummies[np.flatnonzero(mt_valid), mt_categories.codes[mt_valid.to_numpy()]] = 1.0
+    mt_dummies_summed = pd.DataFrame(mt_dummies, columns=[f'{letter}_mt_sum' for letter in mt_categories.categories], index=mt_df.index)
+
+    # The haplogroup sum corresponds to the number of individuals found at any given sampling site 
+    y_dummies_summed["y_haplos_sum"] = y_valid.astype(np.float32)
+    mt_dummies_summed["mt_haplos_sum"] = mt_valid.astype(np.float32)
 
     # Append the modified dummies to the original DataFrame and proceed with aggregation
     y_df = pd.concat([y_df, y_dummies_summed], axis=1)
@@ -280,6 +284,21 @@ def createDummyVariables (y_df, mt_df) :
 
     return y_df, mt_df
 
+def combineDataFrames(y_df, mt_df) :
+    '''
+    Combines the Y-chromosome and mitochondrial DNA dataframes side by side. Both are subsets of the same AADR rows, so they are aligned on their shared index rather than merged.
+
+    input: mitochondrial DNA dataframe and Y-chromosome dataframe containing basal haplogroups and dummy-variable dataframe for each.
+    output: A data frame carrying the mt- and y-haplogroups for each observation.
+    '''
+    # Sample information (ID, coordinates, bins) is present in both dataframes, keep one copy per observation
+    shared_cols = y_df.columns.intersection(mt_df.columns)
+    sample_df = pd.concat([y_df[shared_cols], mt_df[shared_cols]])
+    sample_df = sample_df[~sample_df.index.duplicated()]
+
+    # Stitch the sample information and the carrier-specific columns together on the index
+    return pd.concat([sample_df, y_df.drop(columns=shared_cols), mt_df.drop(columns=shared_cols)], axis=1)
+
 def createTable(combined_df) :
     '''
     Concatenates the dummy table and the dataframes correpsodning to Y-chromosome and mitochondrial DNA AADR.
@@ -287,31 +306,28 @@ def createTable(combined_df) :
     input: mitochondrial DNA dataframe and Y-chromosome dataframe containing basal haplogroups and dummy-variable dataframe for each.
     output: A data frame per genetic carrier which is composed of the dummy variables dataframe concatenated with the corresponding longitudes, latitudes and bins.
     '''
-    def custom_aggregate(series):
-        if series.dtype == 'float64' or series.dtype == 'int64':
-            return series.sum()  # Sum for numeric columns
-        else:
-            # Return the first non-NA string value in the series
-            return series.dropna().iloc[0] if not series.dropna().empty else None
+    group_cols = ['Lat.', 'Long.', 'CombinedBins']
 
+    # Sum the numeric columns and keep the first non-NA value of the remaining (string) columns
+    inds_agg_dict = {col: 'sum' if pd.api.types.is_numeric_dtype(combined_df[col]) else 'first' for col in combined_df.columns if col not in group_cols}
 
     # Group by long, lat and combinedbins in order to visualise overlapping data points 
-    combined_df_inds = combined_df.groupby(['Lat.', 'Long.', 'CombinedBins']).agg(custom_aggregate).reset_index()
+    combined_df_inds = combined_df.groupby(group_cols, observed=True).agg(inds_agg_dict).reset_index()
 
-    # Define the aggregation dictionary
-    agg_dict = {}
-    
-    # Include all columns carrying haplogroup information
-    for col in combined_df.columns:
-        if col.endswith('_sum') or col.endswith('y_haplos_sum') or col.endswith('mt_haplos_sum'):
-            agg_dict[col] = 'sum'
-    
-    # Aggregate the observations to the nation-time bins (ex Sweden 0-999 BP)
-    combined_df = combined_df.groupby(['CombinedBins'], as_index=False, observed=True).agg(agg_dict)
-    
-    # Ensure the sum of haplogroups are numeric
-    combined_df['y_haplos_sum'] = pd.to_numeric(combined_df['y_haplos_sum'], errors='coerce')
-    combined_df['mt_haplos_sum'] = pd.to_numeric(combined_df['mt_haplos_sum'], errors='coerce')
+    # Include all columns carrying haplogroup information, as a single (observations, haplogroups) array. Missing values from the merge count as 0
+    sum_cols = [col for col in combined_df.columns if col.endswith('_sum')]
+    sums = np.nan_to_num(combined_df[sum_cols].to_numpy(dtype=np.float32))
+
+    # Sort the observations by nation-time bin, observations without a bin are left out
+    bin_codes, bin_labels = pd.factorize(combined_df['CombinedBins'], sort=True)
+    order = np.argsort(bin_codes, kind='stable')
+    order = order[bin_codes[order] >= 0]
+    sorted_codes = bin_codes[order]
+
+    # Aggregate the observations to the nation-time bins (ex Sweden 0-999 BP), summing each run of equal bins in one pass
+    bin_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    combined_df = pd.DataFrame(np.add.reduceat(sums[order], bin_starts, axis=0), columns=sum_cols)
+    combined_df.insert(0, 'CombinedBins', bin_labels[sorted_codes[bin_starts]])
 
     # Return a data frame, binned by nation and time. For each bin, the y-haplogroups and mt-haplogroups are registered 
     return combined_df, combined_df_inds
@@ -322,11 +338,11 @@ def saveToFile(combined_df_inds, combined_df_nations) :
 
     input: A data frame per genetic carrier which is composed of the dummy variables dataframe concatenated with the corresponding longitudes, latitudes and bins.
     '''
-    # Save the combined_df_inds as a CSV file
-    combined_df_inds.to_csv('/home/andrewbergman/courses/binp29/pop_gen/all_observations.csv', index=False)
+    # Save the combined_df_inds as a CSV file in the directory HaploMapper is run from. Arrow's vectorised writer is used instead of the row-by-row pandas formatter
+    pa_csv.write_csv(pa.Table.from_pandas(combined_df_inds, preserve_index=False), os.path.join(os.getcwd(), 'all_observations.csv'))
 
     # Save the combined_df_nations as a CSV file
-    combined_df_nations.to_csv('/home/andrewbergman/courses/binp29/pop_gen/national_obersvations.csv', index=False)
+    pa_csv.write_csv(pa.Table.from_pandas(combined_df_nations, preserve_index=False), os.path.join(os.getcwd(), 'national_obersvations.csv'))
 
 def createWebApplication(combined_df_inds, combined_df_nations) :
     '''
@@ -367,26 +383,35 @@ def createWebApplication(combined_df_inds, combined_df_nations) :
         'Z': '#d9d9d9'
     }
 
-    # Bin with respect to time
-    timeBins = combined_df_inds['CombinedBins'].str.split("(", n=1, expand = True)[1].str.split(")", n=1, expand=True)[0] 
-    parts = combined_df_inds['CombinedBins'].str.split(" ", n=1, expand = True)
-    
-    # Retrieve the countries (political entities) for color-coding the interactive map.
-    if len(parts) > 2 : 
-        country = combined_df_inds['CombinedBins'].str.split(" ", n=1, expand = True)[0] + " " + combined_df_inds['CombinedBins'].str.split(" ", n=1, expand = True)[1]
-    else : 
-        country = combined_df_inds['CombinedBins'].str.split(" ", n=1, expand = True)[0]
-
-    # add times and ages to the dataframe
-    combined_df_inds['Time'] = timeBins
-    combined_df_inds['Country'] = country
-    combined_df_inds['SortKey'] = combined_df_inds['Time'].apply(lambda x: int(x.split('-')[0]))
-
-    # Step 2: Sort the dataframe based on the new 'SortKey' column
-    combined_df_inds_sorted = combined_df_inds.sort_values(by='SortKey')
+    # Index the sampling sites and the nation bins once, so that the callbacks retrieve a row by a dictionary lookup
+    inds_index = {(longitude, latitude, combined_bin): index for index, (longitude, latitude, combined_bin) in enumerate(zip(combined_df_inds['Long.'], combined_df_inds['Lat.'], combined_df_inds['CombinedBins']))}
+    nation_index = {combined_bin: index for index, combined_bin in enumerate(combined_df_nations['CombinedBins'])}
+
+    # Extract the haplogroup sums as arrays, with a parallel array of haplogroup names
+    y_sum_cols = [col for col in combined_df_inds.columns if col.endswith('_y_sum')]
+    mt_sum_cols = [col for col in combined_df_inds.columns if col.endswith('_mt_sum')]
+    y_haplos = np.array([col.replace('_y_sum', '') for col in y_sum_cols])
+    mt_haplos = np.array([col.replace('_mt_sum', '') for col in mt_sum_cols])
+    y_sum_mat = combined_df_inds[y_sum_cols].to_numpy()
+    mt_sum_mat = combined_df_inds[mt_sum_cols].to_numpy()
+    y_nation_sum_mat = combined_df_nations[y_sum_cols].to_numpy()
+    mt_nation_sum_mat = combined_df_nations[mt_sum_cols].to_numpy()
+
+    # Split the bins into the countries (political entities) and the time bins for color-coding the interactive map, e.g. "Spain (0-999BP)" -> "Spain", "0-999BP", 0
+    bin_parts = combined_df_inds['CombinedBins'].str.extract(r'^(?P<Country>.*?) \((?P<Time>(?P<SortKey>\d+)-\d+BP)\)$')
+
+    # Only pass the columns used by the map, sorted by the start of the time bin
+    plot_df = pd.DataFrame({
+        'Lat.': combined_df_inds['Lat.'],
+        'Long.': combined_df_inds['Long.'],
+        'CombinedBins': combined_df_inds['CombinedBins'],
+        'Time': bin_parts['Time'].astype('category'),
+        'Country': bin_parts['Country'].astype('category'),
+        'SortKey': bin_parts['SortKey'].astype(np.int32)
+    }).sort_values(by='SortKey', kind='stable')
 
     # Now generate the interactive map using the sorted dataframe
-    fig = px.scatter_geo(combined_df_inds_sorted, lat='Lat.', lon='Long.',
+    fig = px.scatter_geo(plot_df, lat='Lat.', lon='Long.',
                         projection="natural earth",
                         custom_data=["Long.", "Lat.", "CombinedBins", 'Country'],
                         color="Time",
@@ -415,7 +440,6 @@ def createWebApplication(combined_df_inds, combined_df_nations) :
         html.H1("HaploMapper", style={'font-family': 'Arial, sans-serif'}),  # Main title
         html.H2("Welcome to HaploMapper, a tool visualizing Allen Ancient DNA Resource (AADR). The map below hosts map markers, each corresponding to observations of basal haplogroups. The map-markers are color-coded by the samples' age. Upon interacting with a map marker, the distribution of basal haplogroups on the Y-chromosome and the mitochondrial DNA are illustrated in pie charts. The data corresponding to the visualisations are saved on your local machine, in the same directory that you ran HaploMapper from.", style={'font-family': 'Arial, sans-serif'}),  # Description
         dcc.Graph(id='map-plot', figure=fig),  # The map plot
-        dcc.Store(id='store-data', data=combined_df_inds.to_dict('records')),
 
         # Container for pie charts
         html.Div([
@@ -442,151 +466,170 @@ def createWebApplication(combined_df_inds, combined_df_nations) :
     ],
     style={'textAlign': 'center', 'width': '80%', 'margin': 'auto'})  # Styling
 
-    # Callback function to display y basal haplogroups upon clicking on a map marker
-    @app.callback(
-        Output('y_pie_chart', 'figure'),
-        [Input('map-plot', 'clickData')]
-    )
-    def display_y_click_data(clickData):
-        if clickData:
-            longitude = clickData['points'][0]['customdata'][0]
-            latitude = clickData['points'][0]['customdata'][1]
-            bin = clickData['points'][0]['customdata'][2]
-
-            y_row = combined_df_inds[(combined_df_inds['Long.'] == longitude) & 
-                                    (combined_df_inds['Lat.'] == latitude) & 
-                                    (combined_df_inds['CombinedBins'] == bin)]
-
-            if not y_row.empty:
-                y_row = y_row.iloc[0]
-                # Create a DataFrame for haplogroups and their frequencies
-                y_haplogroups = pd.DataFrame({
-                    'Haplogroup': [col.replace('_y_sum', '') for col in y_row.index if col.endswith('_y_sum') and y_row[col] > 0],
-                    'Frequency': [y_row[col] for col in y_row.index if col.endswith('_y_sum') and y_row[col] > 0]
-                })
+    # Cache the pie charts, so that repeated clicks on the same map marker are not rebuilt. Cleared on start-up as the figures depend on the loaded data
+    cache = Cache(app.server, config={'CACHE_TYPE': 'FileSystemCache', 'CACHE_DIR': '/tmp/haplomapper', 'CACHE_DEFAULT_TIMEOUT': 3600})
+    cache.clear()
+
+    # Function retrieving data from the Y dataframe and returns a pie chart for a sampling site
+    @cache.memoize()
+    def build_y_pie_chart(longitude, latitude, bin):
+        index = inds_index.get((longitude, latitude, bin))
+
+        if index is not None:
+            y_row = y_sum_mat[index]
+            # Create a DataFrame for the haplogroups observed at the site and their frequencies
+            y_haplogroups = pd.DataFrame({
+                'Haplogroup': y_haplos[y_row > 0],
+                'Frequency': y_row[y_row > 0]
+            })
 
             if not y_haplogroups.empty:
-                title_text = f'Basal Y Haplogroup Distribution at the Selected Sampling Site: {longitude}; {latitude}.<br>There are {int(y_row["y_haplos_sum"])} samples at this site.'
+                title_text = f'Basal Y Haplogroup Distribution at the Selected Sampling Site: {longitude}; {latitude}.<br>There are {int(combined_df_inds["y_haplos_sum"].iat[index])} samples at this site.'
                 fig = px.pie(y_haplogroups, names='Haplogroup', values='Frequency', title=title_text)
                 # Apply the color mapping
                 fig.update_traces(marker=dict(colors=[color_map[haplo] for haplo in y_haplogroups['Haplogroup']]))
                 return fig
 
         return px.pie(title='No Y Haplogroup Data Selected')
+
+    # Function retrieving data from the mt dataframe and returns a pie chart for a sampling site
+    @cache.memoize()
+    def build_mt_pie_chart(longitude, latitude, bin):
+        index = inds_index.get((longitude, latitude, bin))
+
+        if index is not None:
+            mt_row = mt_sum_mat[index]
+            mt_haplogroups = pd.DataFrame({
+                'Haplogroup': mt_haplos[mt_row > 0],
+                'Frequency': mt_row[mt_row > 0]
+            })
+
+            if not mt_haplogroups.empty:
+                title_text = f'Basal MT Haplogroup Distribution at the Selected Sampling Site: {longitude}; {latitude}.<br>There are {int(combined_df_inds["mt_haplos_sum"].iat[index])} samples at this site.'
+                fig = px.pie(mt_haplogroups, names='Haplogroup', values='Frequency', title=title_text)
+                fig.update_traces(marker=dict(colors=[color_map[haplo] for haplo in mt_haplogroups['Haplogroup']]))
+                return fig
+
+        return px.pie(title='No MT Haplogroup Data Selected')
+
+    # Function retrieving data from the Y dataframe and returns a pie chart for a nation bin
+    @cache.memoize()
+    def build_y_nation_pie_chart(bin):
+        index = nation_index.get(bin)
+
+        if index is not None:
+            y_row_nation = y_nation_sum_mat[index]
+            y_haplogroups_nation = pd.DataFrame({
+                'Haplogroup': y_haplos[y_row_nation > 0],
+                'Frequency': y_row_nation[y_row_nation > 0]
+            })
+
+            if not y_haplogroups_nation.empty:
+                fig = px.pie(y_haplogroups_nation, names='Haplogroup', values='Frequency',
+                            title='Basal Y Haplogroups Distribution in ' + bin + ' There are ' + str(int(combined_df_nations['y_haplos_sum'].iat[index])) + " samples in total.")
+                fig.update_traces(marker=dict(colors=[color_map[haplo] for haplo in y_haplogroups_nation['Haplogroup']]))
+                return fig
+
+        return px.pie(title='No Y Haplogroup Data Selected')
+
+    # Function retrieving data from the mt dataframe and returns a pie chart for a nation bin
+    @cache.memoize()
+    def build_mt_nation_pie_chart(bin):
+        index = nation_index.get(bin)
+
+        if index is not None:
+            mt_row_nation = mt_nation_sum_mat[index]
+            mt_haplogroups_nation = pd.DataFrame({
+                'Haplogroup': mt_haplos[mt_row_nation > 0],
+                'Frequency': mt_row_nation[mt_row_nation > 0]
+            })
+
+            if not mt_haplogroups_nation.empty:
+                fig = px.pie(mt_haplogroups_nation, names='Haplogroup', values='Frequency',
+                            title='Basal MT Haplogroups Distribution in ' + bin + ' There are ' + str(int(combined_df_nations['mt_haplos_sum'].iat[index])) + " samples in total.")
+                fig.update_traces(marker=dict(colors=[color_map[haplo] for haplo in mt_haplogroups_nation['Haplogroup']]))
+                return fig
+
+        return px.pie(title='No MT Haplogroup Data Selected')
+
+    # Callback function to display y basal haplogroups upon clicking on a map marker
+    @app.callback(
+        Output('y_pie_chart', 'figure'),
+        [Input('map-plot', 'clickData')]
+    )
+    def display_y_click_data(clickData):
+        if clickData:
+            longitude, latitude, bin = clickData['points'][0]['customdata'][:3]
+            return build_y_pie_chart(longitude, latitude, bin)
+        return px.pie(title='No Y Haplogroup Data Selected')
         
     # Callback function to display mt basal haplogroups upon clicking on a map marker
     @app.callback(
         Output('mt_pie_chart', 'figure'),
         [Input('map-plot', 'clickData')]
     )
-    # Function retrieving data from the mt dataframe and returns a pie chart
     def display_mt_click_data(clickData):
         if clickData:
-            longitude = clickData['points'][0]['customdata'][0]
-            latitude = clickData['points'][0]['customdata'][1]
-            bin = clickData['points'][0]['customdata'][2]
-            
-            mt_row = combined_df_inds[(combined_df_inds['Long.'] == longitude) & 
-                                    (combined_df_inds['Lat.'] == latitude) & 
-                                    (combined_df_inds['CombinedBins'] == bin)]
-            
-            if not mt_row.empty:
-                mt_row = mt_row.iloc[0]
-                mt_haplogroups = pd.DataFrame({
-                    'Haplogroup': [col.replace('_mt_sum', '') for col in mt_row.index if col.endswith('_mt_sum') and mt_row[col] > 0],
-                    'Frequency': [mt_row[col] for col in mt_row.index if col.endswith('_mt_sum') and mt_row[col] > 0]
-                })
-
-                if not mt_haplogroups.empty:
-                    title_text = f'Basal MT Haplogroup Distribution at the Selected Sampling Site: {longitude}; {latitude}.<br>There are {int(mt_row["mt_haplos_sum"])} samples at this site.'
-                    fig = px.pie(mt_haplogroups, names='Haplogroup', values='Frequency', title=title_text)
-                    fig.update_traces(marker=dict(colors=[color_map[haplo] for haplo in mt_haplogroups['Haplogroup']]))
-                    return fig
-
+            longitude, latitude, bin = clickData['points'][0]['customdata'][:3]
+            return build_mt_pie_chart(longitude, latitude, bin)
         return px.pie(title='No MT Haplogroup Data Selected')
     
-    # Callback function to display y basal haplogroups upon clicking on a map marker
+    # Callback function to display y basal haplogroups of the nation bin upon clicking on a map marker
     @app.callback(
         Output('y_pie_chart_nation', 'figure'),
         [Input('map-plot', 'clickData')]
     )
-    # Function retrieving data from the Y dataframe and returns a pie chart
     def display_y_nation_click_data(clickData):
         if clickData:
-            bin = clickData['points'][0]['customdata'][2]
-            y_row_nation = combined_df_nations[combined_df_nations['CombinedBins'] == bin]
-            
-            if not y_row_nation.empty:
-                y_row_nation = y_row_nation.iloc[0]
-                y_haplogroups_nation = pd.DataFrame({
-                    'Haplogroup': [col.replace('_y_sum', '') for col in y_row_nation.index if col.endswith('_y_sum') and y_row_nation[col] > 0],
-                    'Frequency': [y_row_nation[col] for col in y_row_nation.index if col.endswith('_y_sum') and y_row_nation[col] > 0]
-                })
-
-                if not y_haplogroups_nation.empty:
-                    fig = px.pie(y_haplogroups_nation, names='Haplogroup', values='Frequency',
-                                title='Basal Y Haplogroups Distribution in ' + bin + ' There are ' + str(int(y_row_nation['y_haplos_sum'])) + " samples in total.")
-                    fig.update_traces(marker=dict(colors=[color_map[haplo] for haplo in y_haplogroups_nation['Haplogroup']]))
-                    return fig
-
+            return build_y_nation_pie_chart(clickData['points'][0]['customdata'][2])
         return px.pie(title='No Y Haplogroup Data Selected')
     
-    # Callback function to display mt basal haplogroups upon clicking on a map marker
+    # Callback function to display mt basal haplogroups of the nation bin upon clicking on a map marker
     @app.callback(
         Output('mt_pie_chart_nation', 'figure'),
         [Input('map-plot', 'clickData')]
     )
-    # Function retrieving data from the mt dataframe and returns a pie chart
     def display_mt_nation_click_data(clickData):
         if clickData:
-            bin = clickData['points'][0]['customdata'][2]
-
-            mt_row_nation = combined_df_nations[combined_df_nations['CombinedBins'] == bin]
-            if not mt_row_nation.empty:
-                mt_row_nation = mt_row_nation.iloc[0]
-                mt_haplogroups_nation = pd.DataFrame({
-                    'Haplogroup': [col.replace('_mt_sum', '') for col in mt_row_nation.index if col.endswith('_mt_sum') and mt_row_nation[col] > 0],
-                    'Frequency': [mt_row_nation[col] for col in mt_row_nation.index if col.endswith('_mt_sum') and mt_row_nation[col] > 0]
-                })
-
-                if not mt_haplogroups_nation.empty:
-                    fig = px.pie(mt_haplogroups_nation, names='Haplogroup', values='Frequency',
-                                title='Basal MT Haplogroups Distribution in ' + bin + ' There are ' + str(int(mt_row_nation['mt_haplos_sum'])) + " samples in total.")
-                    fig.update_traces(marker=dict(colors=[color_map[haplo] for haplo in mt_haplogroups_nation['Haplogroup']]))
-                    return fig
-
+            return build_mt_nation_pie_chart(clickData['points'][0]['customdata'][2])
         return px.pie(title='No MT Haplogroup Data Selected')
     
-    if __name__ == '__main__':
-        app.run_server(debug=False, port=8052) 
-
-#Retrive the file paths
-mt_mut_file, mt_basal_file, y_snp_file, y_locus_file, y_basal_file, anno_file, bin_choice = boot()
-
-
-
-# Calling functions
-y_df, mt_df = open_data(anno_file)
-y_df, mt_df = create_bins(y_df, mt_df, bin_choice)
-y_df = findYBasalHaplogroups(y_df, y_snp_file, y_basal_file, y_locus_file)
-mt_df = findMTBasalHaplogroups(mt_df, mt_mut_file, mt_basal_file)
-y_df, mt_df = createDummyVariables(y_df, mt_df)
-
-# Merge y_df and mt_df into a dataframe carrying the mt- and y-haplogroups for each observation
-combined_df_inds = pd.merge(y_df, mt_df, on=['Master ID', 'CombinedBins', 'Lat.', 'Long.'], how='outer')
-combined_df_nations, combined_df_inds = createTable(combined_df_inds)
-saveToFile(combined_df_inds, combined_df_nations)
+    return app
 
+def main():
+    '''
+    Runs the HaploMapper pipeline and launches the web application. Kept out of module scope so that importing HaploMapper does not prompt for input or process the AADR dataset.
+    '''
+    #Retrive the file paths
+    file_paths = boot()
+    if file_paths is None:
+        return
+    mt_mut_file, mt_basal_file, y_snp_file, y_locus_file, y_basal_file, anno_file, bin_choice = file_paths
+
+    # Calling functions
+    y_df, mt_df = open_data(anno_file)
+    y_df, mt_df = create_bins(y_df, mt_df, bin_choice)
+    y_df = findYBasalHaplogroups(y_df, y_snp_file, y_basal_file, y_locus_file)
+    mt_df = findMTBasalHaplogroups(mt_df, mt_mut_file, mt_basal_file)
+    y_df, mt_df = createDummyVariables(y_df, mt_df)
+
+    # Combine y_df and mt_df into a dataframe carrying the mt- and y-haplogroups for each observation
+    combined_df_inds = combineDataFrames(y_df, mt_df)
+    combined_df_nations, combined_df_inds = createTable(combined_df_inds)
+    saveToFile(combined_df_inds, combined_df_nations)
+
+    # The reloader would restart the process and re-run the whole pipeline, so it is disabled
+    app = createWebApplication(combined_df_inds, combined_df_nations)
+    app.run(debug=False, use_reloader=False, port=8052)
 
-# Group by 'Lat.' and 'Long.' and apply custom aggregation
-    
 ################################################
     # Tweaka UI 
     # Ändra readme och artikel
     # Fixa git och github, se till att länka i artikeln
     # 
 
-createWebApplication(combined_df_inds, combined_df_nations)
+if __name__ == '__main__':
+    main()
 
                                               
                                               